@@ -1,86 +1,138 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
-import re
-from typing import Optional, Dict
-from openpyxl.styles import PatternFill, Font
+import functools
+import xlsxwriter
+from typing import Optional, Dict, Tuple
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Global dictionary to store unknown device mappings
 unknown_device_mappings: Dict[str, str] = {}
 
 # --- Classification Logic ---
 
+# (keyword, category) in priority order; the first keyword present decides the category.
+# BAC-I is checked before COMBO, so a COMBO with BACI never falls through to I-CAB.
+DEVICE_RULES = [
+    ('beame', 'BEAME'),
+    ('blame', 'BEAME'),
+    ('baci', 'BAC-I'),
+    ('bai03', 'BAC-I'),
+    ('icabm', 'I-CAB M'),
+    ('icabh', 'I-CAB H'),
+    ('combo', 'I-CAB'),
+    ('icab', 'I-CAB'),
+]
+DEVICE_KEYWORDS = [kw for kw, _ in DEVICE_RULES]
+
+# Single-pass keyword scanner; falls back to substring tests without pyahocorasick
+if ahocorasick is not None:
+    _keyword_automaton = ahocorasick.Automaton()
+    for _kw in DEVICE_KEYWORDS:
+        _keyword_automaton.add_word(_kw, _kw)
+    _keyword_automaton.make_automaton()
+else:
+    _keyword_automaton = None
+
+def find_device_keywords(norm: str) -> set:
+    """
+    Return the set of DEVICE_KEYWORDS found in a normalized device name.
+    """
+    if _keyword_automaton is not None:
+        return {kw for _, kw in _keyword_automaton.iter(norm)}
+    return {kw for kw in DEVICE_KEYWORDS if kw in norm}
+
+@functools.lru_cache(maxsize=4096)
 def classify_device_type(device: str) -> Optional[str]:
     """
     Classify device into one of the known categories:
     - BAC-I, I-CAB, I-CAB H, I-CAB M, BEAME
     Based on presence of keywords in the device name.
+    Results are memoized, since the same device names recur across rows and sheets.
     """
     if not isinstance(device, str):
         return None
 
     # Normalize
     norm = device.strip().lower().replace('-', '').replace('_', '').replace(' ', '')
+    hits = find_device_keywords(norm)
 
-    # BEAME
-    if 'beame' in norm or 'blame' in norm:
-        return 'BEAME'
-
-    # BAC-I
-    if 'baci' in norm or 'bai03' in norm:
-        return 'BAC-I'
-
-    # I-CAB M
-    if re.search(r'\bicabm\b', norm) or 'icabm' in norm:
-        return 'I-CAB M'
-
-    # I-CAB H
-    if re.search(r'\bicabh\b', norm) or 'icabh' in norm:
-        return 'I-CAB H'
-
-    # COMBO without BACI → treat as I-CAB
-    if 'combo' in norm and 'baci' not in norm:
-        return 'I-CAB'
-
-    # General I-CAB
-    if 'icab' in norm:
-        return 'I-CAB'
+    for kw, category in DEVICE_RULES:
+        if kw in hits:
+            return category
 
     return None
 
-def classify_device_type_with_overrides(device: str) -> Optional[str]:
+def classify_device_type_with_overrides(device: str, mappings: Optional[Dict[str, str]] = None) -> Optional[str]:
     """
     Classify device using user overrides if present, else fall back to default classification.
+    Uses unknown_device_mappings unless an explicit mappings dict is given.
     """
     if not isinstance(device, str):
         return None
 
+    if mappings is None:
+        mappings = unknown_device_mappings
     key = device.strip()
-    if key in unknown_device_mappings:
-        return unknown_device_mappings[key]
+    if key in mappings:
+        return mappings[key]
     return classify_device_type(device)
 
 # --- Sheet Processing ---
 
+if njit is not None:
+    @njit(cache=True)
+    def sum_by_customer(cust_codes, cat_codes, qty, n_cust, n_cat):
+        """
+        Sum qty into a customer x category table, skipping rows coded -1.
+        """
+        out = np.zeros((n_cust, n_cat), np.int64)
+        for i in range(len(qty)):
+            k = cust_codes[i]
+            c = cat_codes[i]
+            if k >= 0 and c >= 0:
+                out[k, c] += qty[i]
+        return out
+else:
+    def sum_by_customer(cust_codes, cat_codes, qty, n_cust, n_cat):
+        """
+        Sum qty into a customer x category table, skipping rows coded -1.
+        """
+        out = np.zeros((n_cust, n_cat), np.int64)
+        valid = (cust_codes >= 0) & (cat_codes >= 0)
+        np.add.at(out, (cust_codes[valid], cat_codes[valid]), qty[valid])
+        return out
+
 def process_flexible_sheet(df: pd.DataFrame, sheet_name: str, classify_func=classify_device_type) -> pd.DataFrame:
     """
     Process any sheet with customer/device/qty columns.
     Uses classify_func() to count devices and adds them to customer rows.
     """
 
-    df = df.copy()
-
     # Detect and optionally use first row as headers
     first_row = df.iloc[0].astype(str).str.lower().str.contains("customer|device|qty").any()
     if first_row:
-        df.columns = [str(c).strip() for c in df.iloc[0]]
-        df = df[1:].reset_index(drop=True)
+        columns = pd.Index([str(c).strip() for c in df.iloc[0]])
+        df = df.iloc[1:]
     else:
-        df.columns = [str(c).strip() for c in df.columns]
+        columns = pd.Index([str(c).strip() for c in df.columns])
 
-    # Drop duplicate or unnamed columns
-    df = df.loc[:, ~df.columns.duplicated()]
-    df = df.loc[:, ~df.columns.str.lower().str.contains('^nan$|^unnamed')]
+    # Drop duplicate or unnamed columns; this selection is the only copy of the input
+    keep = ~columns.duplicated() & ~columns.str.lower().str.contains('^nan$|^unnamed')
+    df = df.take(np.flatnonzero(keep), axis=1)
+    df.columns = columns[keep]
+    if first_row:
+        df.index = pd.RangeIndex(len(df))
 
     # Find expected columns
     col_map: Dict[str, Optional[str]] = {
@@ -106,50 +158,44 @@ def process_flexible_sheet(df: pd.DataFrame, sheet_name: str, classify_func=clas
 
     categories = ['BAC-I', 'I-CAB', 'I-CAB H', 'I-CAB M', 'BEAME']
     for cat in categories:
-        df[cat] = ''
-
-    grouped = df.groupby(col_map['customer'])
-
-    for customer, group in grouped:
-        counts = {cat: 0 for cat in categories}
-
-        for _, row in group.iterrows():
-            device = row.get(col_map['device'], '')
-            qty = row.get(col_map['qty'], 0)
-
-            try:
-                qty = int(qty)
-            except:
-                qty = 0
+        df[cat] = pd.array([pd.NA] * len(df), dtype='Int64')
+
+    # Classify each distinct device name once, then map back onto all rows
+    uniq = df[col_map['device']].dropna().unique()
+    lookup = {d: classify_func(d) for d in uniq}
+    df['_cat'] = df[col_map['device']].map(lookup)
+    # Non-numeric, non-finite or out-of-int64-range quantities count as 0
+    # (the float round-trip loses integer precision above 2**53)
+    qty = pd.to_numeric(df[col_map['qty']], errors='coerce').astype(float)
+    df['_qty'] = qty.where(np.isfinite(qty) & (qty.abs() < 2 ** 63), 0).astype(np.int64)
+
+    # Group on integer category codes rather than hashing customer strings
+    df['_cust'] = df[col_map['customer']].astype('category')
+    codes = df['_cust'].cat.codes.to_numpy()
+    cat_codes = pd.Categorical(df['_cat'], categories=categories).codes
+
+    # Sum quantities per customer x category
+    # intp codes keep one compiled signature whatever width pandas picked for the codes
+    totals = sum_by_customer(
+        codes.astype(np.intp), cat_codes.astype(np.intp), df['_qty'].to_numpy(np.int64),
+        len(df['_cust'].cat.categories), len(categories)
+    )
 
-            category = classify_func(device)
-            if category:
-                counts[category] += qty
+    # Mark the first row of each customer once; reused for totals, blanking and NEW QTY
+    _, first_positions = np.unique(codes, return_index=True)
+    first_positions = first_positions[codes[first_positions] >= 0]
+    first_mask = np.zeros(len(df), dtype=bool)
+    first_mask[first_positions] = True
 
-        # Write totals into first row of group
-        first_row = group.index[0]
-        for col, val in counts.items():
-            df.at[first_row, col] = val
+    # Write totals into first row of each customer group
+    df.loc[first_mask, categories] = totals[codes[first_mask]]
 
     # Clean up: blank Customer Code except in first row
-    for customer, group in grouped:
-        indexes = group.index.tolist()
-        if len(indexes) > 1:
-            for idx in indexes[1:]:
-                df.at[idx, col_map['customer']] = ''
+    df.loc[~first_mask & (codes >= 0), col_map['customer']] = ''
 
     # Add NEW QTY = sum of the 5 summary columns (only on first row)
-    df['NEW QTY'] = ''
-    for customer, group in grouped:
-        first_row = group.index[0]
-        total = 0
-        for col in categories:
-            try:
-                val = df.at[first_row, col]
-                total += int(val) if val not in [None, ''] else 0
-            except:
-                pass
-        df.at[first_row, 'NEW QTY'] = total
+    df['NEW QTY'] = pd.array([pd.NA] * len(df), dtype='Int64')
+    df.loc[first_mask, 'NEW QTY'] = df.loc[first_mask, categories].sum(axis=1)
 
     # Reorder columns: original 3 + NEW QTY + summary (I-CAB before BAC-I)
     final_order = [
@@ -176,6 +222,101 @@ def process_sheet_if_applicable(df: pd.DataFrame, sheet_name: str, classify_func
         return df
     return process_flexible_sheet(df, sheet_name, classify_func=classify_func)
 
+# Bounded caches so a long-running server does not keep every upload forever
+@st.cache_data(max_entries=4, ttl="1h")
+def read_sheets(file_bytes: bytes) -> Dict[str, pd.DataFrame]:
+    """
+    Parse every sheet of the workbook in one pass.
+    Uses the calamine engine when python-calamine is installed, else openpyxl.
+    Cached on the file contents, so reruns (e.g. submitting overrides) skip parsing.
+    """
+    try:
+        return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, engine='calamine')
+    except ImportError:
+        return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, engine='openpyxl')
+
+# Excel number format per kind of temporal column, as reported by infer_dtype
+TEMPORAL_NUM_FORMATS = {
+    'datetime64': 'yyyy-mm-dd hh:mm:ss',
+    'datetime': 'yyyy-mm-dd hh:mm:ss',
+    'date': 'yyyy-mm-dd',
+    'time': 'hh:mm:ss',
+    'timedelta64': '[h]:mm:ss',
+    'timedelta': '[h]:mm:ss',
+}
+
+def export_sheets(processed_sheets: Dict[str, pd.DataFrame]) -> bytes:
+    """
+    Write processed sheets to an in-memory Excel workbook.
+    Customer rows get a gray fill and a bold NEW QTY cell.
+    """
+    output = io.BytesIO()
+    # Save to Excel in memory; constant_memory flushes each row once the next one starts
+    options = {
+        'constant_memory': True,
+        'nan_inf_to_errors': True,
+    }
+    with xlsxwriter.Workbook(output, options) as workbook:
+        # Formats are registered once per workbook and shared by every styled row
+        header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        row_fmt = workbook.add_format({'bg_color': '#DDDDDD'})
+        qty_fmt = workbook.add_format({'bg_color': '#DDDDDD', 'bold': True})
+        temporal_fmts = {
+            kind: (workbook.add_format({'num_format': num}),
+                   workbook.add_format({'num_format': num, 'bg_color': '#DDDDDD'}))
+            for kind, num in TEMPORAL_NUM_FORMATS.items()
+        }
+
+        for sheet_name, df in processed_sheets.items():
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, list(df.columns), header_fmt)
+
+            # Customer rows: gray fill for row, bold NEW QTY
+            if "Customer Code" in df.columns and "NEW QTY" in df.columns:
+                qty_col_index = df.columns.get_loc("NEW QTY")
+                customer = df["Customer Code"]
+                mask = (customer.notna() & customer.astype(str).str.strip().ne("")).to_numpy()
+            else:
+                qty_col_index = None
+                mask = np.zeros(len(df), dtype=bool)
+
+            # Date, time and timedelta columns each get their own number format
+            temporal_cols = []
+            for j in range(df.shape[1]):
+                kind = pd.api.types.infer_dtype(df.iloc[:, j], skipna=True)
+                if kind in temporal_fmts:
+                    temporal_cols.append((j, temporal_fmts[kind]))
+
+            # Write each row once, in order, with missing values as blank cells
+            rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+            for i, row in enumerate(rows):
+                if mask[i]:
+                    worksheet.write_row(i + 1, 0, row, row_fmt)
+                    worksheet.write(i + 1, qty_col_index, row[qty_col_index], qty_fmt)
+                else:
+                    worksheet.write_row(i + 1, 0, row)
+                for j, (plain_fmt, filled_fmt) in temporal_cols:
+                    if row[j] is not None:
+                        worksheet.write(i + 1, j, row[j], filled_fmt if mask[i] else plain_fmt)
+    return output.getvalue()
+
+@st.cache_data(max_entries=16, ttl="1h")
+def process_workbook(file_bytes: bytes, overrides: Tuple[Tuple[str, str], ...] = ()) -> Tuple[Dict[str, pd.DataFrame], bytes]:
+    """
+    Parse, process and export the workbook.
+    overrides is a sorted tuple of (device, category) pairs, so identical inputs hit the cache.
+    """
+    if overrides:
+        classify_func = functools.partial(classify_device_type_with_overrides, mappings=dict(overrides))
+    else:
+        classify_func = classify_device_type
+
+    processed_sheets = {}
+    for sheet, df in read_sheets(file_bytes).items():
+        processed_sheets[sheet] = process_sheet_if_applicable(df, str(sheet), classify_func=classify_func)
+
+    return processed_sheets, export_sheets(processed_sheets)
+
 def style_customer_rows(df: pd.DataFrame, customer_col: str):
     """
     Apply bold + underline style to rows where customer code is present.
@@ -203,15 +344,10 @@ uploaded_file = st.file_uploader("📤 Upload an Excel file", type=["xlsx"])
 
 if uploaded_file:
     st.success("File uploaded successfully.")
-    xls = pd.ExcelFile(uploaded_file)
-
-    processed_sheets = {}
+    file_bytes = uploaded_file.getvalue()
 
     # First pass: process sheets with default classification
-    for sheet in xls.sheet_names:
-        df = xls.parse(sheet)
-        processed_df = process_sheet_if_applicable(df, str(sheet))
-        processed_sheets[sheet] = processed_df
+    processed_sheets, output = process_workbook(file_bytes)
 
     # Collect unknown device types from all sheets
     unknown_devices_set = set()
@@ -249,33 +385,7 @@ if uploaded_file:
             unknown_device_mappings = {k: v for k, v in unknown_device_mappings.items() if v != 'Select category'}
 
             # Re-process sheets with overrides
-            processed_sheets = {}
-            for sheet in xls.sheet_names:
-                df = xls.parse(sheet)
-                processed_df = process_sheet_if_applicable(df, str(sheet), classify_func=classify_device_type_with_overrides)
-                processed_sheets[sheet] = processed_df
-
-    output = io.BytesIO()
-    # Save to Excel in memory
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        for sheet_name, df in processed_sheets.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-            # Apply formatting to customer rows: gray fill for row, bold NEW QTY
-            worksheet = writer.sheets[sheet_name]
-            if "Customer Code" in df.columns and "NEW QTY" in df.columns:
-                customer_col_index = df.columns.get_loc("Customer Code")
-                qty_col_index = df.columns.get_loc("NEW QTY")
-
-                for row_idx, val in enumerate(df["Customer Code"], start=2):
-                    if pd.notna(val) and str(val).strip() != "":
-                        for col_idx in range(1, len(df.columns) + 1):
-                            worksheet.cell(row=row_idx, column=col_idx).fill = PatternFill(
-                                start_color="DDDDDD", end_color="DDDDDD", fill_type="solid"
-                            )
-                        new_qty_cell = worksheet.cell(row=row_idx, column=qty_col_index + 1)
-                        new_qty_cell.font = Font(bold=True)
-    output.seek(0)
+            processed_sheets, output = process_workbook(file_bytes, tuple(sorted(unknown_device_mappings.items())))
 
     # Download button
     st.download_button(